@@ -0,0 +1,61 @@
+#!/bin/env python
+"""Memory benchmark for holding many loaded mouse configs in one process.
+Loads CONFIG (defaults.json by default) COUNT times, as full G600MouseMapping
+objects and as G600CompactMouseMapping, and reports the bytes used per profile.
+For reference, the raw config is 462 bytes (3 modes of 154 bytes).
+
+$ ./bench_memory.py
+$ ./bench_memory.py my_config.json -n 10000"""
+from __future__ import print_function
+import sys
+import os
+import argparse
+import contextlib
+import io
+import tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import g600prog
+
+
+def main(argv):
+    cfg = parseArgs(argv)
+    with contextlib.redirect_stdout(io.StringIO()):
+        modeRawBytesList = g600prog.readMouseMappingFromFile(cfg.CONFIG, False).toModeRawBytesList()
+    rawSize = sum(len(modeRawBytes) for modeRawBytes in modeRawBytesList)
+    print("raw config: {} bytes per profile".format(rawSize))
+    for name, loadFn in (("G600MouseMapping", loadMouseMapping),
+                         ("G600CompactMouseMapping", g600prog.G600CompactMouseMapping)):
+        bytesPerProfile = measureBytesPerProfile(loadFn, modeRawBytesList, cfg.count)
+        print("{}: {:.0f} bytes per profile ({:.1f}x raw), {} profiles".format(name, bytesPerProfile,
+                                                                            bytesPerProfile / rawSize, cfg.count))
+
+
+def loadMouseMapping(modeRawBytesList):
+    mouseMapping = g600prog.G600MouseMapping()
+    mouseMapping.fromModeRawBytesList(modeRawBytesList)
+    return mouseMapping
+
+
+def measureBytesPerProfile(loadFn, modeRawBytesList, count):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        profiles = [loadFn(modeRawBytesList) for i in range(count)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del profiles
+    return (after - before) / count
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('CONFIG', nargs='?',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "defaults.json"),
+                        help='Config file to load.  Default: defaults.json',)
+    parser.add_argument('-n', '--count', type=int, default=1000,
+                        help='Number of profiles to load.  Default: %(default)s',)
+    return parser.parse_args(argv[1:])
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -22,32 +22,60 @@ import itertools
 import json
 import collections
 import time
-import usb.core
-import usb.util
+import math
+import errno
+import hashlib
+import select
+import struct
+import ctypes
+import ctypes.util
+import fcntl
+import io
+import contextlib
+import concurrent.futures
+import cmd
+import shlex
+try:
+    import usb.core  # only needed by the pyusb transport
+    import usb.util
+except ImportError:
+    usb = None
+try:
+    import orjson  # optional, faster compact json output
+except ImportError:
+    orjson = None
 
 
 def main(argv):
+    if len(argv) > 1 and argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[argv[1]](argv[2:])
+        return
     cfg = parseArgs(argv)
+    transport = transportFromCfg(cfg)
+    if cfg.watch is not None:
+        watchFileToMouse(cfg.watch, cfg.debug, cfg.dry_run, transport)
+        return
     if cfg.SOURCE == "MOUSE":
-        mouseMapping = readMouseMappingFromMouse(cfg.debug)
+        mouseMapping = readMouseMappingFromMouse(cfg.debug, transport)
     else:
         mouseMapping = readMouseMappingFromFile(cfg.SOURCE, cfg.debug)
-    if cfg.bytes:
-        mouseMappingBytes = G600MouseMappingBytes()
+    if cfg.bytes or cfg.hex_bytes:
+        mouseMappingBytes = G600MouseMappingHexBytes() if cfg.hex_bytes else G600MouseMappingBytes()
         mouseMappingBytes.fromModeRawBytesList(mouseMapping.toModeRawBytesList())
         mouseMapping = mouseMappingBytes
     if cfg.DESTINATION is None:
-        print(mouseMapping)
+        mouseMapping.writeJson(sys.stdout, cfg.compact)
+        print()
     elif cfg.DESTINATION == "MOUSE":
-        writeMouseMappingToMouse(mouseMapping, cfg.debug, cfg.dry_run)
+        writeMouseMappingToMouse(mouseMapping, cfg.debug, cfg.dry_run, transport)
     else:
-        saveMouseMappingToFile(mouseMapping, cfg.DESTINATION, cfg.overwrite_file)
+        saveMouseMappingToFile(mouseMapping, cfg.DESTINATION, cfg.overwrite_file, cfg.compact)
 
 
-def readMouseMappingFromMouse(debug):
+def readMouseMappingFromMouse(debug, transport=None):
     print("Reading mouse config from mouse...")
     mouseMapping = G600MouseMapping()
-    rawModeBytesList = readUsbMouseMappingRawBytes(debug)
+    rawModeBytesList = readUsbMouseMappingRawBytes(debug, transport)
     mouseMapping.fromModeRawBytesList(rawModeBytesList)
     print("... done reading mouse config from mouse")
     return mouseMapping
@@ -57,44 +85,154 @@ def readMouseMappingFromFile(fileName, debug):
     print("Reading mouse config from file >{}< ...".format(fileName))
     with open(fileName, 'r') as fileHandle:
         jsonObj = json.loads(fileHandle.read())
-        mouseMapping = G600MouseMapping()
+        if not isinstance(jsonObj, dict):
+            raise FromJsonError("expected a json object at the top of >{}<, saw {}".format(fileName, type(jsonObj).__name__))
         if "configFormat" not in jsonObj:
             raise FromJsonError("missing configFormat!")
-        if jsonObj["configFormat"] == "BytesFormat":
-            mouseMappingBytes = G600MouseMappingBytes()
-            mouseMappingBytes.simpleRepr = jsonObj
-            mouseMapping.fromModeRawBytesList(mouseMappingBytes.toModeRawBytesList())
-        elif jsonObj["configFormat"] == "HumanReadableFormat":
+        if jsonObj["configFormat"] not in CONFIG_FORMAT_TYPES:
+            raise FromJsonError("Undefined configFormat >>{}<<".format(jsonObj["configFormat"]))
+        errors = validateSimpleRepr(CONFIG_FORMAT_SCHEMAS[jsonObj["configFormat"]], jsonObj)
+        if len(errors) > 0:
+            errStr = "{} errors in >{}<:\n".format(len(errors), fileName)
+            raise FromJsonError(errStr + "\n".join(errors))
+        mouseMapping = G600MouseMapping()
+        mappingType = CONFIG_FORMAT_TYPES[jsonObj["configFormat"]]
+        if mappingType is G600MouseMapping:
             mouseMapping.simpleRepr = jsonObj
         else:
-            raise FromJsonError("Undefined configFormat >>{}<<".format(jsonObj["configFormat"]))
+            mouseMappingBytes = mappingType()
+            mouseMappingBytes.simpleRepr = jsonObj
+            mouseMapping.fromModeRawBytesList(mouseMappingBytes.toModeRawBytesList())
     print("... done reading mouse config from file")
     return mouseMapping
 
 
-def saveMouseMappingToFile(mouseMapping, fileName, forceWrite):
+def saveMouseMappingToFile(mouseMapping, fileName, forceWrite, compact=False):
     print("Saving the mouse config to file >{}< ...".format(fileName))
     if os.path.isfile(fileName) and not forceWrite:
         raise Exception("File already exists and overwrite-file flag not set")
     with open(fileName, "w") as fileHandle:
-        fileHandle.write(mouseMapping.json)
+        mouseMapping.writeJson(fileHandle, compact)
     print("...done saving the mouse config to file")
 
 
-def writeMouseMappingToMouse(mouseMapping, debug, dryRun):
+def writeMouseMappingToMouse(mouseMapping, debug, dryRun, transport=None):
     print("Writing the mouse config to the mouse...")
     rawModeBytesList = mouseMapping.toModeRawBytesList()
-    writeUsbMouseMappingRawBytes(rawModeBytesList, debug, dryRun)
+    writeUsbMouseMappingRawBytes(rawModeBytesList, debug, dryRun, transport)
     print("...done writing read mouse config to the mouse")
 
 
+def writeChangedModesToMouse(rawModeBytesList, currentRawModeBytesList, debug, dryRun, transport=None):
+    """Writes only the modes of rawModeBytesList that differ from currentRawModeBytesList.
+    Returns the list of mode indexes that were written.
+    """
+    changedModes = []
+    rawModeBytesList = list(rawModeBytesList)
+    for modeIdx, currentRawBytes in enumerate(currentRawModeBytesList):
+        if rawModeBytesList[modeIdx][0x1:] == currentRawBytes[0x1:]:
+            rawModeBytesList[modeIdx] = None
+        else:
+            changedModes.append(modeIdx)
+    if len(changedModes) == 0:
+        print("No modes differ from the mouse, nothing to write")
+    else:
+        print("Writing changed modes {} to the mouse...".format(", ".join(str(m + 1) for m in changedModes)))
+        writeUsbMouseMappingRawBytes(rawModeBytesList, debug, dryRun, transport)
+        print("...done writing changed modes to the mouse")
+    return changedModes
+
+
+def snapshotMain(argv):
+    cfg = parseSnapshotArgs(argv)
+    if cfg.SOURCE == "MOUSE":
+        mouseMapping = readMouseMappingFromMouse(cfg.debug, transportFromCfg(cfg))
+    else:
+        mouseMapping = readMouseMappingFromFile(cfg.SOURCE, cfg.debug)
+    journal = G600SnapshotJournal(cfg.JOURNAL)
+    index = journal.append(mouseMapping.toModeRawBytesList(), cfg.SOURCE)
+    print("Appended snapshot {} to journal >{}<".format(index, cfg.JOURNAL))
+
+
+def rollbackMain(argv):
+    cfg = parseRollbackArgs(argv)
+    journal = G600SnapshotJournal(cfg.JOURNAL)
+    if cfg.list:
+        for index, entry in enumerate(journal.entries()):
+            print("{:5d} {} {}".format(index, entry["time"], entry["source"]))
+        return
+    rawModeBytesList = journal.getModeRawBytesList(cfg.INDEX)
+    transport = transportFromCfg(cfg)
+    # one device session for the read and the write
+    with transport:
+        currentRawModeBytesList = readUsbMouseMappingRawBytes(cfg.debug, transport)
+        writeChangedModesToMouse(rawModeBytesList, currentRawModeBytesList, cfg.debug, cfg.dry_run, transport)
+
+
+def lintMain(argv):
+    cfg = parseLintArgs(argv)
+    fileNames = findConfigFiles(cfg.FILES)
+    cache = {} if cfg.no_cache else loadLintCache(cfg.cache)
+    contentHashes = {fileName: fileContentHash(fileName) for fileName in fileNames}
+    # each content is checked once, its result is shared by every file with that content.
+    # unreadable files have no content hash, they are checked every time and never cached
+    toCheck = []
+    hashesToCheck = set()
+    for fileName in fileNames:
+        contentHash = contentHashes[fileName]
+        if contentHash is None:
+            toCheck.append(fileName)
+        elif contentHash not in cache and contentHash not in hashesToCheck:
+            hashesToCheck.add(contentHash)
+            toCheck.append(fileName)
+    if len(toCheck) > 1 and cfg.jobs != 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=cfg.jobs) as executor:
+            results = list(executor.map(lintConfigFile, toCheck, chunksize=8))
+    else:
+        results = [lintConfigFile(fileName) for fileName in toCheck]
+    checkedResults = dict(zip(toCheck, results))
+    for fileName, result in checkedResults.items():
+        if contentHashes[fileName] is not None:
+            cache[contentHashes[fileName]] = result
+    numFailed = 0
+    for fileName in fileNames:
+        result = checkedResults[fileName] if fileName in checkedResults else cache[contentHashes[fileName]]
+        for errStr in lintMessages(result, "errors", fileName):
+            print("{}: error: {}".format(fileName, errStr))
+        for warnStr in lintMessages(result, "warnings", fileName):
+            print("{}: warning: {}".format(fileName, warnStr))
+        if len(result["errors"]) > 0 or (cfg.strict and len(result["warnings"]) > 0):
+            numFailed += 1
+    if not cfg.no_cache:
+        saveLintCache(cfg.cache, {contentHash: cache[contentHash] for contentHash in contentHashes.values()
+                                  if contentHash is not None})
+    print("{} files, {} checked, {} cached, {} failed".format(len(fileNames), len(toCheck),
+                                                              len(fileNames) - len(toCheck), numFailed))
+    if numFailed > 0:
+        sys.exit(1)
+
+
+def shellMain(argv):
+    cfg = parseShellArgs(argv)
+    with G600Shell(transportFromCfg(cfg), cfg.debug, cfg.dry_run) as shell:
+        if cfg.SOURCE == "MOUSE":
+            shell.mouseMapping = G600MouseMapping()
+            shell.mouseMapping.fromModeRawBytesList(shell._baseline())
+        else:
+            shell.mouseMapping = readMouseMappingFromFile(cfg.SOURCE, cfg.debug)
+        try:
+            shell.cmdloop()
+        except KeyboardInterrupt:
+            print()
+
+
 def parseArgs(argv):
     description = __doc__
     parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
     if len(argv) == 1:
         argv.append('-h')
 
-    parser.add_argument('SOURCE',
+    parser.add_argument('SOURCE', nargs='?', default=None,
                         help='Configuration source, can be MOUSE for the mouse itself or a filename.',)
     parser.add_argument('DESTINATION', nargs='?', default=None,
                         help='Optional configuration destination, can be the MOUSE or filename.  If omitted, prints to stdout.',)
@@ -107,13 +245,122 @@ def parseArgs(argv):
     parser.add_argument('-d', '--debug',
                         help='Turn on debug printing.',
                         action='store_true',)
-    parser.add_argument('--bytes',
-                        help='Store output config in JSON byte array format.  This could be useful for moving betweeen versions of this app where the human readable JSON format changes.',
+    formatGroup = parser.add_mutually_exclusive_group()
+    formatGroup.add_argument('--bytes',
+                             help='Store output config in JSON byte array format.  This could be useful for moving betweeen versions of this app where the human readable JSON format changes.',
+                             action='store_true',)
+    formatGroup.add_argument('--hex-bytes',
+                             help='Store output config in JSON hex string format, one hex string per mode.  Like --bytes but smaller and faster to load.  Giving a --bytes file as SOURCE converts it.',
+                             action='store_true',)
+    parser.add_argument('-c', '--compact',
+                        help='Store output config as canonical compact JSON: no whitespace, and byte-identical output for identical configs.  Uses orjson when installed.',
                         action='store_true',)
+    addUsbTransferArgs(parser)
+    parser.add_argument('-w', '--watch', metavar='FILE', default=None,
+                        help='Watch FILE and push it to the mouse every time it is saved.  Only modes that changed since the last push are written.  Runs until ctrl-c.',)
 
     cfg = parser.parse_args()
+    if cfg.SOURCE is None and cfg.watch is None:
+        parser.error("SOURCE is required unless --watch is given")
+    if cfg.watch is not None and (cfg.SOURCE is not None or cfg.DESTINATION is not None):
+        parser.error("--watch always pushes FILE to the mouse, SOURCE and DESTINATION cannot be given with it")
+    return cfg
+
+
+def addUsbTransferArgs(parser):
+    parser.add_argument('-t', '--transport', default='auto',
+                        help='How to reach the mouse: hidraw (no driver detach needed), pyusb, auto (hidraw if the mouse has a hidraw node, else pyusb), file:PATH (a json file standing in for the mouse, for testing) or replay:PATH (play back a --trace file).  Default: %(default)s',)
+    parser.add_argument('--trace', metavar='FILE', default=None,
+                        help='Record every usb transfer, with its timing, and kernel driver detach/attach events to FILE.  Play it back with --transport replay:FILE.',)
+    parser.add_argument('--usb-timeout', metavar='MS', type=int, default=None,
+                        help='Timeout for each usb transfer attempt, in milliseconds.  The hidraw transport cannot change the kernel\'s own {} ms timeout, so setting this makes auto use pyusb.  Default: {}'.format(HIDRAW_KERNEL_TIMEOUT_MS, G600_TRANSFER_TIMEOUT_MS),)
+    parser.add_argument('--usb-retries', metavar='N', type=int, default=G600_TRANSFER_RETRIES,
+                        help='Number of times a failed usb transfer is retried.  Default: %(default)s',)
+    parser.add_argument('--usb-deadline', metavar='SECONDS', type=float, default=G600_SESSION_DEADLINE,
+                        help='Give up if a whole mouse read or write takes longer than this.  Default: %(default)s',)
+
+
+def transportFromCfg(cfg):
+    timeoutMs = G600_TRANSFER_TIMEOUT_MS if cfg.usb_timeout is None else cfg.usb_timeout
+    policy = UsbTransferPolicy(timeoutMs=timeoutMs, retries=cfg.usb_retries, deadline=cfg.usb_deadline)
+    transportName = cfg.transport
+    if transportName == "auto" and (cfg.usb_timeout is not None or cfg.usb_deadline * 1000 < HIDRAW_KERNEL_TIMEOUT_MS):
+        # hidraw cannot honour a shorter bound than the kernel timeout
+        transportName = PyUsbTransport.NAME
+    transport = makeTransport(transportName, cfg.debug, policy)
+    if cfg.trace is not None:
+        transport = TracingTransport(transport, cfg.trace)
+    return transport
+
+
+def addDeviceArgs(parser):
+    parser.add_argument('-n', '--dry-run',
+                        help='Do everything except for actually send the usb programming messages.',
+                        action='store_true',)
+    parser.add_argument('-d', '--debug',
+                        help='Turn on debug printing.',
+                        action='store_true',)
+    addUsbTransferArgs(parser)
+
+
+def parseSnapshotArgs(argv):
+    description = "Append a mouse config snapshot to a journal file (one journal per mouse)."
+    parser = argparse.ArgumentParser(prog="g600prog.py snapshot", description=description)
+    parser.add_argument('SOURCE',
+                        help='Configuration source, can be MOUSE for the mouse itself or a filename.',)
+    parser.add_argument('JOURNAL',
+                        help='Journal file to append to, created if it does not exist.',)
+    # snapshot only reads the mouse, so there is no --dry-run
+    parser.add_argument('-d', '--debug',
+                        help='Turn on debug printing.',
+                        action='store_true',)
+    addUsbTransferArgs(parser)
+    return parser.parse_args(argv)
+
+
+def parseLintArgs(argv):
+    description = "Check many config files, reporting load errors and quantization warnings.  Results are cached by file content, so unchanged files are skipped on later runs."
+    parser = argparse.ArgumentParser(prog="g600prog.py lint", description=description)
+    parser.add_argument('FILES', nargs='+',
+                        help='Config files, or directories to search for *.json config files.',)
+    parser.add_argument('--cache', default=LINT_CACHE_FILE,
+                        help='Result cache file.  Default: %(default)s',)
+    parser.add_argument('--no-cache',
+                        help='Check every file, and do not read or write the cache.',
+                        action='store_true',)
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of worker processes.  Default: one per cpu',)
+    parser.add_argument('--strict',
+                        help='Treat warnings as failures.',
+                        action='store_true',)
+    cfg = parser.parse_args(argv)
+    if cfg.jobs is not None and cfg.jobs < 1:
+        parser.error("--jobs must be at least 1")
     return cfg
 
+
+def parseShellArgs(argv):
+    description = "Interactive shell that edits a config in memory, writing to the mouse only on commit.  The mouse is opened when first needed and kept open until the shell exits."
+    parser = argparse.ArgumentParser(prog="g600prog.py shell", description=description)
+    parser.add_argument('SOURCE',
+                        help='Config to start from, MOUSE for the mouse itself or a filename.',)
+    addDeviceArgs(parser)
+    return parser.parse_args(argv)
+
+
+def parseRollbackArgs(argv):
+    description = "Write a journaled snapshot back to the mouse, sending only the modes that differ."
+    parser = argparse.ArgumentParser(prog="g600prog.py rollback", description=description)
+    parser.add_argument('JOURNAL',
+                        help='Journal file written by the snapshot command.',)
+    parser.add_argument('INDEX', nargs='?', default=-1, type=int,
+                        help='Snapshot index to roll back to, negative counts from the end.  Defaults to the latest.',)
+    parser.add_argument('-l', '--list',
+                        help='List the snapshots in the journal instead of rolling back.',
+                        action='store_true',)
+    addDeviceArgs(parser)
+    return parser.parse_args(argv)
+
 ################################################################################
 # usb read/write to the mouse control interface.
 # Operates on a 3 element sequence where each element is a bytearray()
@@ -128,77 +375,575 @@ G600_READ_IDX = G600_CONTROL_INTERFACE
 G600_READ_LENGTH = 154
 
 
-def readUsbMouseMappingRawBytes(debug=False):
+G600_WRITE_REQTYPE = 0x21
+G600_WRITE_REQ = 0x09
+G600_WRITE_IDX = G600_CONTROL_INTERFACE
+G600_WRITE_SETTLE_TIME = 1.1  # seconds the mouse needs after each config write
+
+G600_TRANSFER_TIMEOUT_MS = 1000  # per control transfer attempt
+HIDRAW_KERNEL_TIMEOUT_MS = 5000  # the usbhid control transfer timeout, hidraw ioctls cannot shorten it
+G600_TRANSFER_RETRIES = 3  # extra attempts per report id before giving up
+G600_TRANSFER_BACKOFF = 0.1  # seconds before the first retry, doubled after each retry
+G600_SESSION_DEADLINE = 15.0  # seconds for a whole read or write, including the post write delays
+
+
+class UsbTransferError(Exception):
+    pass
+
+
+class UsbTransferFatalError(UsbTransferError):
+    """A transfer error that retrying cannot fix, raised without retries"""
+    pass
+
+
+class UsbTransferPolicy(object):
+    """Timeouts, retries and overall deadline for one usb session (a read or a write).
+    Also counts transfers, retries and timeouts so they can be reported.
+    """
+
+    def __init__(self, timeoutMs=G600_TRANSFER_TIMEOUT_MS, retries=G600_TRANSFER_RETRIES,
+                 backoff=G600_TRANSFER_BACKOFF, deadline=G600_SESSION_DEADLINE):
+        super(UsbTransferPolicy, self).__init__()
+        self.timeoutMs = timeoutMs
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+        self.startSession()
+
+    def startSession(self):
+        self.startTime = time.monotonic()
+        self.numTransfers = 0
+        self.numRetries = 0
+        self.numTimeouts = 0
+
+    def remainingSeconds(self):
+        return self.startTime + self.deadline - time.monotonic()
+
+    def report(self):
+        reportStr = "usb: {} transfers, {} retries, {} timeouts in {:.2f} s"
+        return reportStr.format(self.numTransfers, self.numRetries, self.numTimeouts,
+                                time.monotonic() - self.startTime)
+
+
+class G600Transport(object):
+    """Base type for the ways of reaching the g600 config interface, do not use this class directly.
+    A transport moves whole feature reports: G600_READ_LENGTH bytes in, one raw mode
+    bytearray out, with the low byte of the report id as the first byte.
+    Use it as a context manager to hold it open across several operations.
+    """
+    NAME = "base"
+    WRITE_SETTLE_TIME = G600_WRITE_SETTLE_TIME
+    FIXED_TIMEOUT_MS = None  # set when transfers ignore the policy timeout and may block this long
+
+    def __init__(self, debug=False, policy=None):
+        super(G600Transport, self).__init__()
+        self.debug = debug
+        self.policy = UsbTransferPolicy() if policy is None else policy
+        self.onEvent = None  # called with the name of driver events, like kernel detach/attach
+        self._depth = 0
+
+    def __enter__(self):
+        if self._depth == 0:
+            self.open()
+        self._depth += 1
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self._depth -= 1
+        if self._depth == 0:
+            if excType is None:
+                self.close()
+            else:
+                # keep the original error, it says more than a failed close
+                try:
+                    self.close()
+                except Exception as err:
+                    print("Warning! closing the {} transport failed: {}".format(self.NAME, err))
+        return False
+
+    @contextlib.contextmanager
+    def operation(self):
+        """One mouse read or write, opening the transport if it is not already open.
+        The policy deadline and the reported counts cover just this operation,
+        so a long lived session (see G600Shell) does not run out of time.
+        """
+        with self:
+            self.policy.startSession()
+            try:
+                yield self
+            finally:
+                print(self.policy.report())
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _event(self, event):
+        if self.onEvent is not None:
+            self.onEvent(event)
+
+    def retryableErrors(self):
+        return (OSError,)
+
+    def isTimeout(self, err):
+        return getattr(err, "errno", None) == errno.ETIMEDOUT
+
+    def _getFeatureReport(self, reportId, timeoutMs):
+        raise NotImplementedError()
+
+    def _setFeatureReport(self, reportId, rawBytes, timeoutMs):
+        raise NotImplementedError()
+
+    def getFeatureReport(self, reportId):
+        return self._transferWithRetry(reportId, G600_READ_LENGTH,
+                                       lambda timeoutMs: self._getFeatureReport(reportId, timeoutMs))
+
+    def setFeatureReport(self, reportId, rawBytes):
+        self._transferWithRetry(reportId, len(rawBytes),
+                                lambda timeoutMs: self._setFeatureReport(reportId, rawBytes, timeoutMs))
+        time.sleep(self.WRITE_SETTLE_TIME)
+
+    def _transferWithRetry(self, reportId, expectLength, transferFn):
+        """transferFn(timeoutMs) bounded by the policy timeouts.
+        Failed transfers, and transfers that do not move expectLength bytes,
+        are retried with exponential backoff until policy.retries or the
+        session deadline runs out.
+        """
+        policy = self.policy
+        attempt = 0
+        while True:
+            remaining = policy.remainingSeconds()
+            if remaining <= 0:
+                errStr = "reportId=0x{:04x}: session deadline of {} s exceeded"
+                raise UsbTransferError(errStr.format(reportId, policy.deadline))
+            if self.FIXED_TIMEOUT_MS is not None and remaining * 1000 < self.FIXED_TIMEOUT_MS:
+                # a blocked attempt could not be cut short, so do not start one that may overrun the deadline
+                errStr = "reportId=0x{:04x}: {:.2f} s left of the {} s session deadline, too little for a {} transfer that may block for {} ms"
+                raise UsbTransferError(errStr.format(reportId, remaining, policy.deadline, self.NAME, self.FIXED_TIMEOUT_MS))
+            timeoutMs = max(1, min(policy.timeoutMs, int(remaining * 1000)))
+            try:
+                result = transferFn(timeoutMs)
+                resultLength = result if isinstance(result, int) else len(result)
+                if resultLength != expectLength:
+                    raise UsbTransferError("transferred {} bytes, expected {} bytes".format(resultLength, expectLength))
+                policy.numTransfers += 1
+                return result
+            except UsbTransferFatalError:
+                raise
+            except (UsbTransferError,) + self.retryableErrors() as err:
+                if self.isTimeout(err):
+                    policy.numTimeouts += 1
+                if attempt >= policy.retries:
+                    errStr = "reportId=0x{:04x}: giving up after {} attempts: {}"
+                    raise UsbTransferError(errStr.format(reportId, attempt + 1, err)) from err
+                backoff = min(policy.backoff * (2 ** attempt), max(0, policy.remainingSeconds()))
+                attempt += 1
+                policy.numRetries += 1
+                if self.debug:
+                    print("for reportId=0x{:04x}, transfer failed ({}), retry {} in {:.2f} s".format(reportId, err, attempt, backoff))
+                time.sleep(backoff)
+
+
+class PyUsbTransport(G600Transport):
+    """Control transfers through pyusb.
+    Needs to detach the kernel driver from the control interface, so usually needs root.
+    """
+    NAME = "pyusb"
+
+    def open(self):
+        if usb is None:
+            raise UsbTransferError("the pyusb transport needs pyusb, which is not installed")
+        self.dev = usb.core.find(idVendor=IDVENDOR, idProduct=IDPRODUCT)
+        if self.dev is None:
+            raise UsbTransferError("no g600 mouse found (idVendor=0x{:04x}, idProduct=0x{:04x})".format(IDVENDOR, IDPRODUCT))
+        self.detached = False
+        if self.dev.is_kernel_driver_active(G600_CONTROL_INTERFACE) is True:
+            # tell the kernel to detach
+            self.dev.detach_kernel_driver(G600_CONTROL_INTERFACE)
+            self.detached = True
+            self._event("detach_kernel_driver")
+            try:
+                # claim the device
+                usb.util.claim_interface(self.dev, G600_CONTROL_INTERFACE)
+            except BaseException:
+                # do not leave the mouse without its kernel driver
+                self._attachKernelDriver()
+                raise
+
+    def close(self):
+        try:
+            # release the device
+            usb.util.release_interface(self.dev, G600_CONTROL_INTERFACE)
+        finally:
+            self._attachKernelDriver()
+
+    def _attachKernelDriver(self):
+        if self.detached:
+            # reattach the device to the OS kernel
+            self.dev.attach_kernel_driver(G600_CONTROL_INTERFACE)
+            self.detached = False
+            self._event("attach_kernel_driver")
+
+    def retryableErrors(self):
+        return (usb.core.USBError,)
+
+    def isTimeout(self, err):
+        return (isinstance(err, getattr(usb.core, "USBTimeoutError", ())) or
+                super(PyUsbTransport, self).isTimeout(err))
+
+    def _getFeatureReport(self, reportId, timeoutMs):
+        return self.dev.ctrl_transfer(bmRequestType=G600_READ_REQTYPE,  # this means control
+                                      bRequest=G600_READ_REQ,
+                                      wValue=reportId,
+                                      wIndex=G600_READ_IDX,
+                                      data_or_wLength=G600_READ_LENGTH,
+                                      timeout=timeoutMs)
+
+    def _setFeatureReport(self, reportId, rawBytes, timeoutMs):
+        return self.dev.ctrl_transfer(bmRequestType=G600_WRITE_REQTYPE,  # this means control
+                                      bRequest=G600_WRITE_REQ,
+                                      wValue=reportId,
+                                      wIndex=G600_WRITE_IDX,
+                                      data_or_wLength=rawBytes,
+                                      timeout=timeoutMs)
+
+
+HIDRAW_SYSFS_DIR = "/sys/class/hidraw"
+HID_BUS_USB = 0x03
+
+
+def hidIoc(nr, length):
+    """_IOC(_IOC_READ | _IOC_WRITE, 'H', nr, length) from linux/hidraw.h"""
+    return (3 << 30) | (length << 16) | (ord('H') << 8) | nr
+
+
+def HIDIOCSFEATURE(length):
+    return hidIoc(0x06, length)
+
+
+def HIDIOCGFEATURE(length):
+    return hidIoc(0x07, length)
+
+
+def findG600HidrawNode(sysfsDir=HIDRAW_SYSFS_DIR):
+    """Returns the /dev/hidrawN path of the g600 control interface, or None"""
+    if not os.path.isdir(sysfsDir):
+        return None
+    for nodeName in sorted(os.listdir(sysfsDir)):
+        devicePath = os.path.realpath(os.path.join(sysfsDir, nodeName, "device"))
+        try:
+            with open(os.path.join(devicePath, "uevent"), 'r') as fileHandle:
+                uevent = dict(line.split("=", 1) for line in fileHandle.read().splitlines() if "=" in line)
+        except OSError:
+            continue
+        hidId = [int(field, 16) for field in uevent.get("HID_ID", "0:0:0").split(":")]
+        # the parent of the hid device is the usb interface, named like 1-2:1.<interfaceNumber>
+        interfaceName = os.path.basename(os.path.dirname(devicePath))
+        if (hidId == [HID_BUS_USB, IDVENDOR, IDPRODUCT] and
+                interfaceName.split(".")[-1] == str(G600_CONTROL_INTERFACE)):
+            return os.path.join("/dev", nodeName)
+    return None
+
+
+class HidrawTransport(G600Transport):
+    """Feature report ioctls on the g600 /dev/hidrawN node.
+    The kernel driver stays attached, so there are no input glitches, and
+    root is not needed if a udev rule grants access to the node.
+    The kernel applies its own usb timeout to the ioctls, policy.timeoutMs
+    is not used, but retries and the session deadline still are: an attempt
+    is only started if the kernel timeout fits in the remaining session time.
+    """
+    NAME = "hidraw"
+    FIXED_TIMEOUT_MS = HIDRAW_KERNEL_TIMEOUT_MS
+
+    def __init__(self, debug=False, policy=None, nodePath=None):
+        super(HidrawTransport, self).__init__(debug, policy)
+        self.nodePath = nodePath
+
+    def open(self):
+        nodePath = findG600HidrawNode() if self.nodePath is None else self.nodePath
+        if nodePath is None:
+            raise UsbTransferError("no g600 hidraw node found under {}".format(HIDRAW_SYSFS_DIR))
+        if self.debug:
+            print("using hidraw node {}".format(nodePath))
+        self.fd = os.open(nodePath, os.O_RDWR | os.O_CLOEXEC)
+
+    def close(self):
+        os.close(self.fd)
+
+    def _getFeatureReport(self, reportId, timeoutMs):
+        buf = bytearray(G600_READ_LENGTH)
+        buf[0] = reportId & 0xff
+        length = fcntl.ioctl(self.fd, HIDIOCGFEATURE(len(buf)), buf, True)
+        return buf[:length]
+
+    def _setFeatureReport(self, reportId, rawBytes, timeoutMs):
+        buf = bytearray(rawBytes)
+        return fcntl.ioctl(self.fd, HIDIOCSFEATURE(len(buf)), buf, True)
+
+
+class FileTransport(G600Transport):
+    """Stand-in for the mouse, backed by a json file of {"0x03f3": "<hex report bytes>", ...}.
+    For testing without a mouse, the file is created with zeroed reports if it does not exist.
+    """
+    NAME = "file"
+    WRITE_SETTLE_TIME = 0
+
+    def __init__(self, fileName, debug=False, policy=None):
+        super(FileTransport, self).__init__(debug, policy)
+        self.fileName = fileName
+
+    def open(self):
+        self.reports = collections.OrderedDict()
+        for reportId in G600_REPORT_IDS:
+            self.reports["0x{:04x}".format(reportId)] = bytearray([reportId & 0xff]) + bytearray(G600_READ_LENGTH - 1)
+        if os.path.isfile(self.fileName):
+            with open(self.fileName, 'r') as fileHandle:
+                for key, hexStr in json.loads(fileHandle.read()).items():
+                    self.reports[key] = bytearray.fromhex(hexStr)
+
+    def close(self):
+        with open(self.fileName, 'w') as fileHandle:
+            fileHandle.write(json.dumps(collections.OrderedDict((key, rawBytes.hex()) for key, rawBytes in self.reports.items()),
+                                        indent=4))
+
+    def _getFeatureReport(self, reportId, timeoutMs):
+        return bytearray(self.reports["0x{:04x}".format(reportId)])
+
+    def _setFeatureReport(self, reportId, rawBytes, timeoutMs):
+        self.reports["0x{:04x}".format(reportId)] = bytearray(rawBytes)
+        return len(rawBytes)
+
+
+G600_TRACE_FORMAT = "G600UsbTrace"
+
+
+class TracingTransport(G600Transport):
+    """Wraps another transport and records every transfer attempt to a json-lines trace file.
+    Records direction, report id (wValue), payload, start time, duration and any error,
+    plus open/close and kernel driver detach/attach events.  ReplayTransport plays it back.
+    """
+    NAME = "trace"
+
+    def __init__(self, transport, fileName):
+        super(TracingTransport, self).__init__(transport.debug, transport.policy)
+        self.transport = transport
+        self.fileName = fileName
+        self.WRITE_SETTLE_TIME = transport.WRITE_SETTLE_TIME
+        self.FIXED_TIMEOUT_MS = transport.FIXED_TIMEOUT_MS
+        self.startTime = None  # set when the trace file is started, on the first open
+        transport.onEvent = self._recordEvent
+
+    def _startTrace(self):
+        # runs that never open the mouse leave an existing trace file alone
+        self.startTime = time.monotonic()
+        header = collections.OrderedDict([("traceFormat", G600_TRACE_FORMAT),
+                                          ("transport", self.transport.NAME),
+                                          ("time", time.strftime("%Y-%m-%dT%H:%M:%S"))])
+        with open(self.fileName, 'w') as fileHandle:
+            fileHandle.write(json.dumps(header, separators=(",", ":")) + "\n")
+
+    def _record(self, entry):
+        # one open per entry, so the trace survives a hang or crash
+        with open(self.fileName, 'a') as fileHandle:
+            fileHandle.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def _newEntry(self, event, startTime):
+        return collections.OrderedDict([("t", round(startTime - self.startTime, 6)), ("event", event)])
+
+    def _recordEvent(self, event):
+        self._record(self._newEntry(event, time.monotonic()))
+
+    def _traced(self, entry, startTime, transferFn):
+        try:
+            result = transferFn()
+        except Exception as err:
+            entry["duration"] = round(time.monotonic() - startTime, 6)
+            entry["error"] = str(err)
+            entry["errno"] = getattr(err, "errno", None)
+            self._record(entry)
+            raise
+        entry["duration"] = round(time.monotonic() - startTime, 6)
+        return result, entry
+
+    def open(self):
+        if self.startTime is None:
+            self._startTrace()
+        startTime = time.monotonic()
+        self._record(self._traced(self._newEntry("open", startTime), startTime, self.transport.open)[1])
+
+    def close(self):
+        startTime = time.monotonic()
+        self._record(self._traced(self._newEntry("close", startTime), startTime, self.transport.close)[1])
+
+    def retryableErrors(self):
+        return self.transport.retryableErrors()
+
+    def isTimeout(self, err):
+        return self.transport.isTimeout(err)
+
+    def _transferEntry(self, direction, reportId, startTime):
+        entry = self._newEntry("transfer", startTime)
+        entry["direction"] = direction
+        entry["wValue"] = "0x{:04x}".format(reportId)
+        return entry
+
+    def _getFeatureReport(self, reportId, timeoutMs):
+        startTime = time.monotonic()
+        entry = self._transferEntry("in", reportId, startTime)
+        result, entry = self._traced(entry, startTime, lambda: self.transport._getFeatureReport(reportId, timeoutMs))
+        entry["data"] = bytes(result).hex()
+        self._record(entry)
+        return result
+
+    def _setFeatureReport(self, reportId, rawBytes, timeoutMs):
+        startTime = time.monotonic()
+        entry = self._transferEntry("out", reportId, startTime)
+        entry["data"] = bytes(rawBytes).hex()
+        result, entry = self._traced(entry, startTime, lambda: self.transport._setFeatureReport(reportId, rawBytes, timeoutMs))
+        entry["length"] = result
+        self._record(entry)
+        return result
+
+
+class ReplayTransport(G600Transport):
+    """Plays back a trace written by TracingTransport, in place of the mouse.
+    Each transfer for a report id gets the next recorded response for that
+    report id and direction, including recorded errors.  Responses keep their
+    original timings: each one starts at its recorded offset (t) from the
+    first replayed entry, and then takes its recorded duration.  Responses
+    wrap around when the trace runs out, so a trace can be replayed many
+    times in one session.
+    """
+    NAME = "replay"
+
+    def __init__(self, fileName, debug=False, policy=None):
+        super(ReplayTransport, self).__init__(debug, policy)
+        self.fileName = fileName
+        with open(fileName, 'r') as fileHandle:
+            lines = fileHandle.read().splitlines()
+        header = json.loads(lines[0]) if len(lines) > 0 else {}
+        if header.get("traceFormat") != G600_TRACE_FORMAT:
+            raise UsbTransferError("{}: not a usb trace".format(fileName))
+        self.recorded = collections.OrderedDict()
+        for line in lines[1:]:
+            entry = json.loads(line)
+            if entry["event"] == "transfer":
+                key = (entry["direction"], int(entry["wValue"], 16))
+            else:
+                key = (entry["event"],)
+            self.recorded.setdefault(key, []).append(entry)
+        self._nextIndex = collections.Counter()
+        self._baseTime = None  # monotonic time that recorded offset t=0 maps to
+        self._lastOffset = None
+
+    def _replay(self, key):
+        entries = self.recorded.get(key)
+        if not entries:
+            return None
+        entry = entries[self._nextIndex[key] % len(entries)]
+        self._nextIndex[key] += 1
+        if self.debug:
+            label = key[0] if len(key) == 1 else "{} reportId=0x{:04x}".format(*key)
+            print("replaying {} from >{}<".format(label, self.fileName))
+        self._waitForEntry(entry)
+        if "error" in entry:
+            raise OSError(entry.get("errno") or errno.EIO, entry["error"])
+        return entry
+
+    def _waitForEntry(self, entry):
+        now = time.monotonic()
+        offset = entry.get("t", 0)
+        if self._baseTime is None or offset < self._lastOffset:
+            # first entry, or the trace wrapped around
+            self._baseTime = now - offset
+        self._lastOffset = offset
+        # the host side sleeps (write settle time, retry backoff) already passed some of the gap
+        time.sleep(max(0, self._baseTime + offset - now))
+        time.sleep(entry.get("duration", 0))
+
+    def open(self):
+        self._replay(("open",))
+
+    def close(self):
+        self._replay(("close",))
+
+    def _getFeatureReport(self, reportId, timeoutMs):
+        entry = self._replay(("in", reportId))
+        if entry is None:
+            raise UsbTransferFatalError("no reads of reportId=0x{:04x} in trace >{}<".format(reportId, self.fileName))
+        return bytearray.fromhex(entry["data"])
+
+    def _setFeatureReport(self, reportId, rawBytes, timeoutMs):
+        entry = self._replay(("out", reportId))
+        if entry is None:
+            raise UsbTransferFatalError("no writes of reportId=0x{:04x} in trace >{}<".format(reportId, self.fileName))
+        if self.debug and entry["data"] != bytes(rawBytes).hex():
+            print("for reportId=0x{:04x}, sent bytes differ from the trace".format(reportId))
+        return entry["length"]
+
+
+def makeTransport(name="auto", debug=False, policy=None):
+    """name is auto, hidraw, pyusb, file:PATH or replay:PATH.
+    auto uses hidraw when the g600 hidraw node can be found, and falls back to pyusb.
+    """
+    if name == "auto":
+        name = HidrawTransport.NAME if findG600HidrawNode() is not None else PyUsbTransport.NAME
+    if name == HidrawTransport.NAME:
+        return HidrawTransport(debug, policy)
+    if name == PyUsbTransport.NAME:
+        return PyUsbTransport(debug, policy)
+    if name.startswith(FileTransport.NAME + ":"):
+        return FileTransport(name[len(FileTransport.NAME) + 1:], debug, policy)
+    if name.startswith(ReplayTransport.NAME + ":"):
+        return ReplayTransport(name[len(ReplayTransport.NAME) + 1:], debug, policy)
+    raise UsbTransferError("unknown transport >>{}<<, expected auto, hidraw, pyusb, file:PATH or replay:PATH".format(name))
+
+
+def readUsbMouseMappingRawBytes(debug=False, transport=None):
     """Returns three element list.
     One for each of the mouse "modes."
     Each list element is a bytearray() type.
     """
+    transport = makeTransport(debug=debug) if transport is None else transport
     if debug:
         print("About to read USB...")
-    dev = usb.core.find(idVendor=IDVENDOR, idProduct=IDPRODUCT)
-    if dev.is_kernel_driver_active(G600_CONTROL_INTERFACE) is True:
-        # tell the kernel to detach
-        dev.detach_kernel_driver(G600_CONTROL_INTERFACE)
-        # claim the device
-        usb.util.claim_interface(dev, G600_CONTROL_INTERFACE)
     modes = []
-    for reportId in G600_REPORT_IDS:
-        replyMsg = dev.ctrl_transfer(bmRequestType=G600_READ_REQTYPE,  # this means control
-                                     bRequest=G600_READ_REQ,
-                                     wValue=reportId,
-                                     wIndex=G600_READ_IDX,
-                                     data_or_wLength=G600_READ_LENGTH,
-                                     timeout=None)
-        if debug:
-            print("for reportId=0x{:04x}, read these bytes: ".format(reportId),)
-            print(" ".join("0x{:02x}".format(x) for x in replyMsg))
-        modes.append(replyMsg)
-    # release the device
-    usb.util.release_interface(dev, G600_CONTROL_INTERFACE)
-    # reattach the device to the OS kernel
-    dev.attach_kernel_driver(G600_CONTROL_INTERFACE)
+    with transport.operation():
+        for reportId in G600_REPORT_IDS:
+            replyMsg = transport.getFeatureReport(reportId)
+            if debug:
+                print("for reportId=0x{:04x}, read these bytes: ".format(reportId),)
+                print(" ".join("0x{:02x}".format(x) for x in replyMsg))
+            modes.append(replyMsg)
     # done
     if debug:
         print("...Done reading USB")
     return modes
 
-G600_WRITE_REQTYPE = 0x21
-G600_WRITE_REQ = 0x09
-G600_WRITE_IDX = G600_CONTROL_INTERFACE
-
 
-def writeUsbMouseMappingRawBytes(modes, debug=False, dryRun=True):
+def writeUsbMouseMappingRawBytes(modes, debug=False, dryRun=True, transport=None):
     """Argument should be a three element list.
     One for each of the mouse "modes."
-    Each list element is a bytearray() type.
+    Each list element is a bytearray() type, or None to leave that mode untouched.
     """
+    transport = makeTransport(debug=debug) if transport is None else transport
     if debug:
         print("About to write USB...")
-    dev = usb.core.find(idVendor=IDVENDOR, idProduct=IDPRODUCT)
-    if dev.is_kernel_driver_active(G600_CONTROL_INTERFACE) is True:
-        # tell the kernel to detach
-        dev.detach_kernel_driver(G600_CONTROL_INTERFACE)
-        # claim the device
-        usb.util.claim_interface(dev, G600_CONTROL_INTERFACE)
-    for reportId, rawBytes in zip(G600_REPORT_IDS, modes):
-        if debug:
-            print("for reportId=0x{:04x}, sending these bytes: ".format(reportId),)
-            print(" ".join("0x{:02x}".format(x) for x in rawBytes))
-        if dryRun:
-            print("dryRun flag set, not sending usb config write message")
-        else:
-            l = dev.ctrl_transfer(bmRequestType=G600_WRITE_REQTYPE,  # this means control
-                                  bRequest=G600_WRITE_REQ,
-                                  wValue=reportId,
-                                  wIndex=G600_WRITE_IDX,
-                                  data_or_wLength=rawBytes,
-                                  timeout=None)
-            assert l == len(rawBytes)
-            time.sleep(1.1)
-    # release the device
-    usb.util.release_interface(dev, G600_CONTROL_INTERFACE)
-    # reattach the device to the OS kernel
-    dev.attach_kernel_driver(G600_CONTROL_INTERFACE)
+    with transport.operation():
+        for reportId, rawBytes in zip(G600_REPORT_IDS, modes):
+            if rawBytes is None:
+                # mode left unchanged
+                continue
+            if debug:
+                print("for reportId=0x{:04x}, sending these bytes: ".format(reportId),)
+                print(" ".join("0x{:02x}".format(x) for x in rawBytes))
+            if dryRun:
+                print("dryRun flag set, not sending usb config write message")
+            else:
+                transport.setFeatureReport(reportId, rawBytes)
     if debug:
         print("...Done writing USB")
     # done
@@ -437,8 +1182,10 @@ class FromJsonError(Exception):
 
 class BaseFieldType(object):
     """Base type the other classes, do not use this class directly"""
+    __slots__ = ("id",)
     ID = "BaseField"
     JSON_INDENT = 4
+    JSON_COMPACT_SEPARATORS = (",", ":")
 
     def __init__(self, byteArray=constant0ByteIter, id=None):
         super(BaseFieldType, self).__init__()  # python2 compatibility
@@ -447,9 +1194,33 @@ class BaseFieldType(object):
     def __str__(self):
         return self.json
 
+    @classmethod
+    def simpleReprError(cls, arg):
+        """Returns a message if arg can not be loaded into this type, else None.
+        Used by the validation schema, so it must not build any objects.
+        """
+        return None
+
     def toJson(self):
         return json.dumps(self.simpleRepr, indent=self.JSON_INDENT)
 
+    def writeJson(self, fileHandle, compact=False):
+        """Serializes directly to fileHandle, without building the whole json string first.
+        orjson (if available) produces the same compact bytes as the json module.
+        """
+        if not compact:
+            json.dump(self.simpleRepr, fileHandle, indent=self.JSON_INDENT)
+        elif orjson is not None:
+            jsonBytes = orjson.dumps(self.simpleRepr)
+            binaryHandle = getattr(fileHandle, "buffer", None)
+            if binaryHandle is None:
+                fileHandle.write(jsonBytes.decode("utf-8"))
+            else:
+                fileHandle.flush()
+                binaryHandle.write(jsonBytes)
+        else:
+            json.dump(self.simpleRepr, fileHandle, separators=self.JSON_COMPACT_SEPARATORS, ensure_ascii=False)
+
     def fromJson(self, jsonStr):
         try:
             self.simpleRepr = json.loads(jsonStr)
@@ -461,6 +1232,7 @@ class BaseFieldType(object):
 
 
 class SingleByteFieldType(BaseFieldType):
+    __slots__ = ("_b",)
     ID = "SingleByteField"
 
     def __init__(self, byteArray=constant0ByteIter, id=None):
@@ -481,6 +1253,12 @@ class SingleByteFieldType(BaseFieldType):
     def toSimpleRepr(self):
         return self._b
 
+    @classmethod
+    def simpleReprError(cls, arg):
+        if isinstance(arg, bool) or not isinstance(arg, int) or arg not in range(0, 256):
+            return "expected an integer in range(0, 256), saw {!r}".format(arg)
+        return None
+
     def fromSimpleRepr(self, arg):
         try:
             bArr = bytearray([arg])
@@ -494,6 +1272,7 @@ class SingleByteFieldType(BaseFieldType):
 
 
 class ArrayFieldType(BaseFieldType):
+    __slots__ = ("numElem", "elemType", "elemList")
     ID = "ArrayField"
     NUM_ELEM = 2
     ELEM_TYPE = SingleByteFieldType
@@ -545,15 +1324,23 @@ class ArrayFieldType(BaseFieldType):
 
 
 class CompositeFieldType(BaseFieldType):
+    __slots__ = ("keyToTypeMap", "elemDict")
     ID = "CompositeField"
     KTM = [("f1", SingleByteFieldType), ("f2", SingleByteFieldType)]
     ERR_FMT_PREFIX = "{id}[{field}]=>"
 
+    @classmethod
+    def classKeyToTypeMap(cls):
+        """OrderedDict of KTM, built once per class and shared by all its instances"""
+        if "_classKeyToTypeMap" not in cls.__dict__:
+            cls._classKeyToTypeMap = collections.OrderedDict(cls.KTM)
+        return cls._classKeyToTypeMap
+
     def __init__(self, byteArray=constant0ByteIter, id=None, keyToTypeMap=None, ):
         super(CompositeFieldType, self).__init__()
         self.id = self.ID if id is None else id
-        self.keyToTypeMap = collections.OrderedDict(self.KTM) if keyToTypeMap is None else collections.OrderedDict(keyToTypeMap)
-        self.elemDict = collections.OrderedDict()
+        self.keyToTypeMap = self.classKeyToTypeMap() if keyToTypeMap is None else collections.OrderedDict(keyToTypeMap)
+        self.elemDict = {}  # insertion ordered, and much smaller than an OrderedDict per instance
         byteArrayIter = iter(byteArray)
         for fieldId in self.keyToTypeMap:
             self.elemDict[fieldId] = self.keyToTypeMap[fieldId](byteArrayIter)
@@ -621,7 +1408,23 @@ def undefinedConvert(arg, id):
     return int(argClean[len(u):])
 
 
+def namedByteError(arg, invDict):
+    """simpleReprError for bytes stored as a name from invDict or UNDEFINEDXXX"""
+    if not isinstance(arg, str):
+        return "expected a name string, saw {!r}".format(arg)
+    u = "UNDEFINED"
+    argClean = cleanStr(arg)
+    if argClean in invDict:
+        return None
+    digits = argClean[len(u):]
+    if argClean[0:len(u)] == u and digits != "" and all(char in "0123456789" for char in digits):
+        if int(digits) in range(0, 256):
+            return None
+    return "unknown name {!r}".format(arg)
+
+
 class G600MouseScanCodeType(SingleByteFieldType):
+    __slots__ = ()
     ID = "mouseScanCode"
 
     def toSimpleRepr(self):
@@ -631,6 +1434,10 @@ class G600MouseScanCodeType(SingleByteFieldType):
         else:
             return "UNDEFINED{:03d}".format(b)
 
+    @classmethod
+    def simpleReprError(cls, arg):
+        return namedByteError(arg, MOUSE_SCAN_CODES_INVDICT)
+
     def fromSimpleRepr(self, arg):
         argClean = cleanStr(arg)
         if argClean in MOUSE_SCAN_CODES_INVDICT:
@@ -641,6 +1448,7 @@ class G600MouseScanCodeType(SingleByteFieldType):
 
 
 class KbModifierBitWiseType(SingleByteFieldType):
+    __slots__ = ()
     ID = "kbModifier"
 
     def toSimpleRepr(self):
@@ -654,6 +1462,18 @@ class KbModifierBitWiseType(SingleByteFieldType):
             retVal = "NO_MOD"
         return retVal
 
+    @classmethod
+    def simpleReprError(cls, arg):
+        if not isinstance(arg, str):
+            return "expected a modifier string, saw {!r}".format(arg)
+        argClean = cleanStr(arg)
+        if argClean == "NO_MOD":
+            return None
+        unknownCodes = [code for code in argClean.split("+") if code not in KB_MODIFIER_BIT_CODES_INVDICT]
+        if len(unknownCodes) > 0:
+            return "unknown modifiers {} in {!r}".format(", ".join(unknownCodes), arg)
+        return None
+
     def fromSimpleRepr(self, arg):
         argClean = cleanStr(arg)
         b = 0
@@ -670,6 +1490,7 @@ class KbModifierBitWiseType(SingleByteFieldType):
 
 
 class KbScanCodeType(SingleByteFieldType):
+    __slots__ = ()
     ID = "kbScanCode"
 
     def toSimpleRepr(self):
@@ -679,6 +1500,10 @@ class KbScanCodeType(SingleByteFieldType):
         else:
             return "UNDEFINED{:03d}".format(b)
 
+    @classmethod
+    def simpleReprError(cls, arg):
+        return namedByteError(arg, KB_SCAN_CODES_INVDICT)
+
     def fromSimpleRepr(self, arg):
         argClean = cleanStr(arg)
         if argClean in KB_SCAN_CODES_INVDICT:
@@ -689,6 +1514,7 @@ class KbScanCodeType(SingleByteFieldType):
 
 
 class G600PollRateType(SingleByteFieldType):
+    __slots__ = ()
     ID = "pollRate"
 
     def calcDerivedPollRate(self, b):
@@ -699,6 +1525,14 @@ class G600PollRateType(SingleByteFieldType):
         b = self.bytes[0]
         return self.calcDerivedPollRate(b)
 
+    @classmethod
+    def simpleReprError(cls, arg):
+        if isinstance(arg, bool) or not isinstance(arg, (int, float)) or not math.isfinite(arg):
+            return "expected a poll rate number, saw {!r}".format(arg)
+        if int(arg) <= 0:
+            return "poll rate must be at least 1, saw {!r}".format(arg)
+        return None
+
     def fromSimpleRepr(self, arg):
         b = int((1000 // int(arg)) - 1)
         if b < 0:
@@ -712,6 +1546,7 @@ class G600PollRateType(SingleByteFieldType):
 
 
 class G600DPIType(SingleByteFieldType):
+    __slots__ = ()
     ID = "dpi"
 
     def calcDerivedDpi(self, b):
@@ -722,6 +1557,12 @@ class G600DPIType(SingleByteFieldType):
         b = self.bytes[0]
         return self.calcDerivedDpi(b)
 
+    @classmethod
+    def simpleReprError(cls, arg):
+        if isinstance(arg, bool) or not isinstance(arg, (int, float)) or not math.isfinite(arg):
+            return "expected a dpi number, saw {!r}".format(arg)
+        return None
+
     def fromSimpleRepr(self, arg):
         b = int((arg) // 50)
         if b < 0:
@@ -737,6 +1578,7 @@ class G600DPIType(SingleByteFieldType):
 
 
 class G600MouseButtonActionType(CompositeFieldType):
+    __slots__ = ()
     KTM = [(G600MouseScanCodeType.ID, G600MouseScanCodeType),
            (KbModifierBitWiseType.ID, KbModifierBitWiseType),
            (KbScanCodeType.ID, KbScanCodeType),
@@ -744,6 +1586,7 @@ class G600MouseButtonActionType(CompositeFieldType):
 
 
 class G600DPIGroupType(CompositeFieldType):
+    __slots__ = ()
     KTM = [('DPI_SHIFT DPI', G600DPIType),
            ('DefaultDPIIndex', SingleByteFieldType),
            ('DPI1', G600DPIType),
@@ -754,6 +1597,7 @@ class G600DPIGroupType(CompositeFieldType):
 
 
 class G600LightingEffectType(SingleByteFieldType):
+    __slots__ = ()
     ID = "lightingEffect"
 
     def toSimpleRepr(self):
@@ -763,6 +1607,10 @@ class G600LightingEffectType(SingleByteFieldType):
         else:
             return "UNDEFINED{:03d}".format(b)
 
+    @classmethod
+    def simpleReprError(cls, arg):
+        return namedByteError(arg, LIGHTING_EFFECT_INVDICT)
+
     def fromSimpleRepr(self, arg):
         argClean = cleanStr(arg)
         if argClean in LIGHTING_EFFECT_INVDICT:
@@ -773,6 +1621,7 @@ class G600LightingEffectType(SingleByteFieldType):
 
 
 class G600LightingType(CompositeFieldType):
+    __slots__ = ()
     ID = "Lighting"
     KTM = [("Lighting Effect", G600LightingEffectType),
            ("Lighting Change Rate (0-15)", SingleByteFieldType),
@@ -780,6 +1629,7 @@ class G600LightingType(CompositeFieldType):
 
 
 class G600LedColorsType(CompositeFieldType):
+    __slots__ = ()
     KTM = [('Red', SingleByteFieldType),
            ('Green', SingleByteFieldType),
            ('Blue', SingleByteFieldType),
@@ -787,6 +1637,7 @@ class G600LedColorsType(CompositeFieldType):
 
 
 class G600ButtonMapType(CompositeFieldType):
+    __slots__ = ()
     ID = "ButtonMap"
     KTM = [('g1 (left button)', G600MouseButtonActionType),
            ('g2 (right button)', G600MouseButtonActionType),
@@ -813,18 +1664,21 @@ class G600ButtonMapType(CompositeFieldType):
 
 
 class UnknownBytesArray0(ArrayFieldType):
+    __slots__ = ()
     ID = "Unknown"
     NUM_ELEM = 0x4b - 0x46
     ELEM_TYPE = SingleByteFieldType
 
 
 class UnknownBytesArray1(ArrayFieldType):
+    __slots__ = ()
     ID = "Unknown"
     NUM_ELEM = 0x5f - 0x52
     ELEM_TYPE = SingleByteFieldType
 
 
 class G600ModeMouseMappingType(CompositeFieldType):
+    __slots__ = ()
     ID = "ConfigMode"
     KTM = [("LedColorsNormal", G600LedColorsType),
            ("Lighting", G600LightingType),
@@ -839,6 +1693,7 @@ class G600ModeMouseMappingType(CompositeFieldType):
 
 
 class StringField(BaseFieldType):
+    __slots__ = ()
     ID = "StringField"
 
     def toByteArray(self):
@@ -855,14 +1710,17 @@ class StringField(BaseFieldType):
 
 
 class G600HumanReadableFormatType(StringField):
+    __slots__ = ()
     ID = "HumanReadableFormat"
 
 
 class G600BytesFormatType(StringField):
+    __slots__ = ()
     ID = "BytesFormat"
 
 
 class G600MouseMapping(CompositeFieldType):
+    __slots__ = ()
     ID = "MouseMapping"
     KTM = [("Mode1 (default)", G600ModeMouseMappingType),
            ("Mode2", G600ModeMouseMappingType),
@@ -902,11 +1760,13 @@ class G600MouseMapping(CompositeFieldType):
 
 
 class G600BytesModeMouseMappingType(ArrayFieldType):
+    __slots__ = ()
     ID = "BytesMouseMapping"
     NUM_ELEM = G600_READ_LENGTH - 1
 
 
 class G600MouseMappingBytes(G600MouseMapping):
+    __slots__ = ()
     ID = "MouseMappingBytes"
     KTM = [("Mode1 (default)", G600BytesModeMouseMappingType),
            ("Mode2", G600BytesModeMouseMappingType),
@@ -914,7 +1774,692 @@ class G600MouseMappingBytes(G600MouseMapping):
            ("configFormat", G600BytesFormatType),
            ]
 
+
+class G600HexBytesFormatType(StringField):
+    __slots__ = ()
+    ID = "HexBytesFormat"
+
+
+class G600HexModeMouseMappingType(BaseFieldType):
+    """A whole mode as one hex string, decoded straight into a bytearray"""
+    __slots__ = ("_bytes",)
+    ID = "HexMouseMapping"
+    NUM_BYTES = G600_READ_LENGTH - 1
+
+    def __init__(self, byteArray=constant0ByteIter, id=None):
+        super(G600HexModeMouseMappingType, self).__init__(byteArray, id)
+        self.bytes = byteArray
+
+    def toByteArray(self):
+        return bytearray(self._bytes)
+
+    def fromByteArray(self, byteArray):
+        self._bytes = bytearray(itertools.islice(iter(byteArray), self.NUM_BYTES))
+
+    def toSimpleRepr(self):
+        return self._bytes.hex()
+
+    @classmethod
+    def simpleReprError(cls, arg):
+        if not isinstance(arg, str):
+            return "expected a hex string, saw {!r}".format(arg)
+        try:
+            numBytes = len(bytearray.fromhex(arg))
+        except ValueError as err:
+            return str(err)
+        if numBytes != cls.NUM_BYTES:
+            return "expected {} bytes, saw {} bytes".format(cls.NUM_BYTES, numBytes)
+        return None
+
+    def fromSimpleRepr(self, arg):
+        try:
+            bArr = bytearray.fromhex(arg)
+        except (TypeError, ValueError) as err:
+            errStr = "{id}: ".format(id=self.id)
+            raise MappingBuildError(errStr + str(err)) from err
+        if len(bArr) != self.NUM_BYTES:
+            errStr = "{id}: expected {expectLen} bytes, saw {actualLen} bytes"
+            raise MappingBuildError(errStr.format(id=self.id, expectLen=self.NUM_BYTES, actualLen=len(bArr)))
+        self._bytes = bArr
+
+    bytes = property(toByteArray, fromByteArray)
+    simpleRepr = property(toSimpleRepr, fromSimpleRepr)
+
+
+class G600MouseMappingHexBytes(G600MouseMapping):
+    __slots__ = ()
+    ID = "MouseMappingHexBytes"
+    KTM = [("Mode1 (default)", G600HexModeMouseMappingType),
+           ("Mode2", G600HexModeMouseMappingType),
+           ("Mode3", G600HexModeMouseMappingType),
+           ("configFormat", G600HexBytesFormatType),
+           ]
+
+
+CONFIG_FORMAT_TYPES = {G600HumanReadableFormatType.ID: G600MouseMapping,
+                       G600BytesFormatType.ID: G600MouseMappingBytes,
+                       G600HexBytesFormatType.ID: G600MouseMappingHexBytes,
+                       }
+
+
+class G600CompactMouseMapping(object):
+    """A whole mouse config as one immutable string of the three raw modes (462 bytes),
+    for holding many profiles in memory.  Use toMouseMapping() to read or edit fields.
+    """
+    __slots__ = ("rawBytes",)
+    NUM_MODES = len(G600_REPORT_IDS)
+
+    def __init__(self, modeRawBytesList=None):
+        super(G600CompactMouseMapping, self).__init__()
+        if modeRawBytesList is None:
+            modeRawBytesList = G600MouseMapping().toModeRawBytesList()
+        self.fromModeRawBytesList(modeRawBytesList)
+
+    def __eq__(self, other):
+        return isinstance(other, G600CompactMouseMapping) and self.rawBytes == other.rawBytes
+
+    def __hash__(self):
+        return hash(self.rawBytes)
+
+    def toModeRawBytesList(self):
+        return [bytearray(self.rawBytes[modeIdx * G600_READ_LENGTH:(modeIdx + 1) * G600_READ_LENGTH])
+                for modeIdx in range(self.NUM_MODES)]
+
+    def fromModeRawBytesList(self, modeRawBytesList):
+        rawBytes = b"".join(bytes(modeRawBytes) for modeRawBytes in modeRawBytesList)
+        if len(rawBytes) != self.NUM_MODES * G600_READ_LENGTH:
+            errStr = "CompactMouseMapping: expected {} modes of {} bytes, saw {} bytes"
+            raise MappingBuildError(errStr.format(self.NUM_MODES, G600_READ_LENGTH, len(rawBytes)))
+        self.rawBytes = rawBytes
+
+    def toMouseMapping(self):
+        mouseMapping = G600MouseMapping()
+        mouseMapping.fromModeRawBytesList(self.toModeRawBytesList())
+        return mouseMapping
+
+    @classmethod
+    def fromMouseMapping(cls, mouseMapping):
+        return cls(mouseMapping.toModeRawBytesList())
+
+################################################################################
+
+################################################################################
+# validation schema
+# Built once from the KTM / ELEM_TYPE declarations, so a whole config can be
+# checked in one pass, collecting every error, before any field objects are built.
+# Schema nodes are tuples:
+#   ("composite", [(fieldId, childNode), ...])
+#   ("array", numElem, childNode)
+#   ("leaf", simpleReprError)
+
+
+def buildValidationSchema(fieldType):
+    if issubclass(fieldType, CompositeFieldType):
+        return ("composite", [(fieldId, buildValidationSchema(childType)) for fieldId, childType in fieldType.KTM])
+    if issubclass(fieldType, ArrayFieldType):
+        return ("array", fieldType.NUM_ELEM, buildValidationSchema(fieldType.ELEM_TYPE))
+    return ("leaf", fieldType.simpleReprError)
+
+
+def validateSimpleRepr(schema, arg, path=""):
+    """Returns a list of "path: message" strings, one for every problem found in arg"""
+    errors = []
+    if schema[0] == "composite":
+        if not isinstance(arg, dict):
+            return ["{}: expected an object, saw {!r}".format(path, arg)]
+        for fieldId, childSchema in schema[1]:
+            childPath = "{}[{}]".format(path, fieldId)
+            if fieldId not in arg:
+                errors.append("{}: missing field".format(childPath))
+            else:
+                errors.extend(validateSimpleRepr(childSchema, arg[fieldId], childPath))
+    elif schema[0] == "array":
+        if not isinstance(arg, list):
+            return ["{}: expected an array, saw {!r}".format(path, arg)]
+        if len(arg) != schema[1]:
+            return ["{}: array length mismatch: expected {} elements, saw {} elements".format(path, schema[1], len(arg))]
+        for index, elem in enumerate(arg):
+            errors.extend(validateSimpleRepr(schema[2], elem, "{}[{}]".format(path, index)))
+    else:
+        errStr = schema[1](arg)
+        if errStr is not None:
+            errors.append("{}: {}".format(path, errStr))
+    return errors
+
+
+CONFIG_FORMAT_SCHEMAS = {configFormat: buildValidationSchema(mappingType)
+                         for configFormat, mappingType in CONFIG_FORMAT_TYPES.items()}
+
+################################################################################
+
 ################################################################################
+# snapshot journal
+# A json-lines file: a header line followed by one line per snapshot.
+# Each snapshot holds the three raw mode byte arrays, either in full (keyframe)
+# or as runs of bytes that changed since the previous snapshot (delta).
+# Every KEYFRAME_INTERVAL-th snapshot is a keyframe, so reaching any snapshot
+# means decoding one keyframe plus at most KEYFRAME_INTERVAL - 1 deltas.
+
+
+def byteDelta(oldBytes, newBytes):
+    """Returns the runs of newBytes that differ from oldBytes as [offset, hexString] pairs"""
+    runs = []
+    runStart = None
+    for offset, (oldByte, newByte) in enumerate(zip(oldBytes, newBytes)):
+        if oldByte != newByte:
+            if runStart is None:
+                runStart = offset
+        elif runStart is not None:
+            runs.append([runStart, newBytes[runStart:offset].hex()])
+            runStart = None
+    if runStart is not None:
+        runs.append([runStart, newBytes[runStart:].hex()])
+    return runs
+
+
+def applyByteDelta(oldBytes, runs):
+    newBytes = bytearray(oldBytes)
+    for offset, hexStr in runs:
+        runBytes = bytearray.fromhex(hexStr)
+        newBytes[offset:offset + len(runBytes)] = runBytes
+    return newBytes
+
+
+class JournalError(Exception):
+    pass
+
+
+class G600SnapshotJournal(object):
+    FORMAT = "G600SnapshotJournal"
+    KEYFRAME_INTERVAL = 16
+
+    def __init__(self, fileName):
+        super(G600SnapshotJournal, self).__init__()
+        self.fileName = fileName
+        self.keyframeInterval = self.KEYFRAME_INTERVAL
+        self._lines = []
+        if os.path.isfile(fileName) and os.path.getsize(fileName) > 0:
+            with open(fileName, 'r') as fileHandle:
+                lines = fileHandle.read().splitlines()
+            try:
+                header = json.loads(lines[0])
+            except ValueError:
+                header = None
+            if not isinstance(header, dict) or header.get("journalFormat") != self.FORMAT:
+                raise JournalError("{}: not a snapshot journal".format(fileName))
+            self.keyframeInterval = header["keyframeInterval"]
+            self._lines = lines[1:]
+
+    def __len__(self):
+        return len(self._lines)
+
+    def _entry(self, index):
+        return json.loads(self._lines[index])
+
+    def entries(self):
+        for line in self._lines:
+            yield json.loads(line)
+
+    def _normalizeIndex(self, index):
+        if index < 0:
+            index += len(self)
+        if index not in range(len(self)):
+            raise JournalError("{}: no snapshot with index {}".format(self.fileName, index))
+        return index
+
+    def getModeRawBytesList(self, index):
+        """Returns the three raw mode bytearrays of the snapshot at index.
+        Only the lines from the nearest keyframe up to index are decoded.
+        """
+        index = self._normalizeIndex(index)
+        keyframeIndex = index - (index % self.keyframeInterval)
+        entry = self._entry(keyframeIndex)
+        modes = [bytearray.fromhex(hexStr) for hexStr in entry["modes"]]
+        for deltaIndex in range(keyframeIndex + 1, index + 1):
+            entry = self._entry(deltaIndex)
+            modes = [applyByteDelta(mode, runs) for mode, runs in zip(modes, entry["modes"])]
+        return modes
+
+    def append(self, modeRawBytesList, source):
+        """Appends a snapshot, returns its index"""
+        index = len(self)
+        entry = collections.OrderedDict()
+        entry["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        entry["source"] = source
+        if index % self.keyframeInterval == 0:
+            entry["keyframe"] = True
+            entry["modes"] = [bytes(mode).hex() for mode in modeRawBytesList]
+        else:
+            prevModes = self.getModeRawBytesList(index - 1)
+            entry["modes"] = [byteDelta(prevMode, bytes(mode))
+                              for prevMode, mode in zip(prevModes, modeRawBytesList)]
+        line = json.dumps(entry, separators=(",", ":"))
+        with open(self.fileName, 'a') as fileHandle:
+            if index == 0 and fileHandle.tell() == 0:
+                header = collections.OrderedDict([("journalFormat", self.FORMAT),
+                                                  ("keyframeInterval", self.keyframeInterval)])
+                fileHandle.write(json.dumps(header, separators=(",", ":")) + "\n")
+            fileHandle.write(line + "\n")
+        self._lines.append(line)
+        return index
+
+################################################################################
+
+################################################################################
+# config file watching
+WATCH_DEBOUNCE = 0.3  # seconds of quiet after a save before the file is re-read
+WATCH_POLL_INTERVAL = 0.5  # seconds, only used when inotify is unavailable
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class FileWatcher(object):
+    """Waits for a file to be saved.
+    Watches the containing directory with inotify, since editors often save by
+    renaming a new file over the old one.  Falls back to polling the file's
+    mtime and size where inotify is not available.
+    """
+
+    def __init__(self, fileName):
+        super(FileWatcher, self).__init__()
+        self.dirName = os.path.dirname(os.path.abspath(fileName))
+        self.baseName = os.fsencode(os.path.basename(fileName))
+        self.fileName = fileName
+        self.fd = None
+        libcName = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(libcName, use_errno=True) if libcName is not None else None
+        if libc is not None and hasattr(libc, "inotify_init1"):
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            if fd >= 0:
+                mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+                if libc.inotify_add_watch(fd, os.fsencode(self.dirName), mask) >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+        self._lastStat = self._stat()
+
+    def _stat(self):
+        try:
+            fileStat = os.stat(self.fileName)
+        except OSError:
+            return None
+        return (fileStat.st_mtime_ns, fileStat.st_size)
+
+    def _readEvents(self, timeout):
+        """Returns True if an event for the watched file arrived within timeout seconds"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        buf = os.read(self.fd, 4096)
+        matched = False
+        offset = 0
+        while offset < len(buf):
+            _, _, _, nameLen = INOTIFY_EVENT_HEADER.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = buf[offset:offset + nameLen].rstrip(b"\0")
+            offset += nameLen
+            matched = matched or name == self.baseName
+        return matched
+
+    def waitForChange(self):
+        """Blocks until the file has been saved and then left alone for WATCH_DEBOUNCE seconds"""
+        if self.fd is None:
+            while self._stat() == self._lastStat:
+                time.sleep(WATCH_POLL_INTERVAL)
+            # debounce, wait for the file to stop changing
+            while True:
+                self._lastStat = self._stat()
+                time.sleep(WATCH_DEBOUNCE)
+                if self._stat() == self._lastStat:
+                    return
+        while not self._readEvents(None):
+            pass
+        # debounce, swallow the rest of a burst of saves
+        while self._readEvents(WATCH_DEBOUNCE):
+            pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def fileContentHash(fileName):
+    try:
+        with open(fileName, 'rb') as fileHandle:
+            return hashlib.sha256(fileHandle.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def watchFileToMouse(fileName, debug, dryRun, transport=None):
+    """Pushes fileName to the mouse now and after every save, until ctrl-c.
+    The file is only re-parsed when its content hash changes, and only the
+    modes whose encoded bytes differ from the last push are written.
+    """
+    currentRawModeBytesList = readUsbMouseMappingRawBytes(debug, transport)
+    lastHash = None
+    watcher = FileWatcher(fileName)
+    print("Watching >{}< for changes, press ctrl-c to stop...".format(fileName))
+    try:
+        while True:
+            contentHash = fileContentHash(fileName)
+            if contentHash is not None and contentHash != lastHash:
+                lastHash = contentHash
+                try:
+                    mouseMapping = readMouseMappingFromFile(fileName, debug)
+                except (ValueError, FromJsonError, MappingBuildError) as err:
+                    print("Not pushing >{}<: {}".format(fileName, err))
+                else:
+                    rawModeBytesList = mouseMapping.toModeRawBytesList()
+                    try:
+                        writeChangedModesToMouse(rawModeBytesList, currentRawModeBytesList, debug, dryRun, transport)
+                    except (UsbTransferError, OSError) as err:
+                        # like a replugged mouse, keep watching and push again on the next save
+                        print("Failed to push >{}< to the mouse: {}".format(fileName, err))
+                        lastHash = None
+                    else:
+                        if not dryRun:
+                            currentRawModeBytesList = rawModeBytesList
+            elif debug:
+                print("content of >{}< unchanged, skipping".format(fileName))
+            watcher.waitForChange()
+    except KeyboardInterrupt:
+        print("...stopped watching >{}<".format(fileName))
+    finally:
+        watcher.close()
+
+################################################################################
+
+################################################################################
+# config file linting
+LINT_CACHE_FILE = ".g600prog-lint-cache.json"
+LINT_FILE_NAME_PLACEHOLDER = "$FILE"  # stands in for the file name in cached messages
+
+
+def findConfigFiles(paths):
+    fileNames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirPath, dirNames, dirFileNames in os.walk(path):
+                # skip hidden entries, like the lint cache
+                dirNames[:] = sorted(name for name in dirNames if not name.startswith("."))
+                fileNames.extend(os.path.join(dirPath, name) for name in sorted(dirFileNames)
+                                 if name.endswith(".json") and not name.startswith("."))
+        else:
+            fileNames.append(path)
+    return fileNames
+
+
+def lintConfigFile(fileName):
+    """Loads fileName and runs it through the encode path.
+    Returns {"errors": [...], "warnings": [...]}, warnings are the messages the
+    field types print, like dpi or poll rate quantization.
+    Results are cached by file content, so fileName is replaced by
+    LINT_FILE_NAME_PLACEHOLDER in the messages, see lintMessages().
+    """
+    errors = []
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            mouseMapping = readMouseMappingFromFile(fileName, False)
+            rawModeBytesList = mouseMapping.toModeRawBytesList()
+        for modeIdx, rawBytes in enumerate(rawModeBytesList):
+            if len(rawBytes) != G600_READ_LENGTH:
+                errors.append("Mode{} encodes to {} bytes, expected {} bytes".format(modeIdx + 1, len(rawBytes), G600_READ_LENGTH))
+        decodedMapping = G600MouseMapping()
+        decodedMapping.fromModeRawBytesList(rawModeBytesList)
+        if decodedMapping.toModeRawBytesList() != rawModeBytesList:
+            errors.append("encoded bytes do not decode back to the same config")
+    except Exception as err:
+        errors.extend("{}: {}".format(type(err).__name__, line) if index == 0 else line
+                      for index, line in enumerate(str(err).splitlines()))
+    warnings = [line for line in output.getvalue().splitlines() if line.startswith("Warning!")]
+    # the same quantization is often repeated in every mode, report it once
+    warnings = list(collections.OrderedDict.fromkeys(warnings))
+    return {"errors": [replaceLintFileName(msg, fileName, LINT_FILE_NAME_PLACEHOLDER) for msg in errors],
+            "warnings": [replaceLintFileName(msg, fileName, LINT_FILE_NAME_PLACEHOLDER) for msg in warnings]}
+
+
+def replaceLintFileName(msg, old, new):
+    """Replaces the file name old with new where msg quotes it, as >name< or 'name'"""
+    for quoteFormat in (">{}<", "'{}'"):
+        msg = msg.replace(quoteFormat.format(old), quoteFormat.format(new))
+    return msg
+
+
+def lintMessages(result, key, fileName):
+    """The result[key] messages of lintConfigFile(), with fileName put back in"""
+    return [replaceLintFileName(msg, LINT_FILE_NAME_PLACEHOLDER, fileName) for msg in result[key]]
+
+
+def lintToolHash():
+    """Hash of this script, so cached results are dropped when the checks change"""
+    return fileContentHash(os.path.abspath(__file__))
+
+
+def loadLintCache(fileName):
+    try:
+        with open(fileName, 'r') as fileHandle:
+            cacheObj = json.loads(fileHandle.read())
+    except (OSError, ValueError):
+        return {}
+    if cacheObj.get("toolHash") != lintToolHash():
+        return {}
+    return cacheObj.get("results", {})
+
+
+def saveLintCache(fileName, results):
+    cacheObj = collections.OrderedDict([("toolHash", lintToolHash()), ("results", results)])
+    with open(fileName, 'w') as fileHandle:
+        fileHandle.write(json.dumps(cacheObj, separators=(",", ":")))
+
+################################################################################
+
+################################################################################
+# interactive shell
+
+
+class ShellError(Exception):
+    pass
+
+
+def fieldChildren(field):
+    """Returns (name, childField) pairs of a composite or array field, empty for other fields"""
+    if isinstance(field, CompositeFieldType):
+        return list(field.elemDict.items())
+    if isinstance(field, ArrayFieldType):
+        return [(str(index), elem) for index, elem in enumerate(field.elemList)]
+    return []
+
+
+def resolveFieldPath(mouseMapping, path):
+    """path is field names joined by ".", like "mode1.dpi.dpi1" or "Mode2.buttonMapNormal.g7.kbScanCode".
+    Each name is matched ignoring case, trying in turn: the full field name,
+    its first word, then the start of the full field name.
+    Returns (field, list of full field names)
+    """
+    field = mouseMapping
+    fullPath = []
+    for name in [name.strip() for name in path.split(".") if name.strip() != ""]:
+        children = fieldChildren(field)
+        name = name.lower()
+        for isMatch in (lambda key: key.lower() == name,
+                        lambda key: key.split(" ")[0].lower() == name,
+                        lambda key: key.lower().startswith(name)):
+            matches = [(key, child) for key, child in children if isMatch(key)]
+            if len(matches) > 0:
+                break
+        parentName = ".".join(fullPath) or "config"
+        if len(matches) == 0:
+            raise ShellError("{}: no field named >{}<".format(parentName, name))
+        if len(matches) > 1:
+            raise ShellError("{}: ambiguous field name >{}<, could be {}".format(
+                parentName, name, ", ".join(">{}<".format(key) for key, child in matches)))
+        key, field = matches[0]
+        fullPath.append(key)
+    return field, fullPath
+
+
+def splitShellPath(arg):
+    """Splits the PATH off the start of a shell command argument, PATH may be quoted
+    to hold spaces, like "mode1.lighting.lighting effect".
+    Returns (path, rest of arg)
+    """
+    lexer = shlex.shlex(arg, posix=True)
+    lexer.whitespace_split = True
+    path = lexer.get_token()
+    return ("" if path is None else path), lexer.instream.read()
+
+
+def simpleReprDiff(oldRepr, newRepr, path=()):
+    """Returns (path, old, new) for every leaf value that differs"""
+    if isinstance(oldRepr, dict) and isinstance(newRepr, dict):
+        diffs = []
+        for key in newRepr:
+            diffs.extend(simpleReprDiff(oldRepr.get(key), newRepr[key], path + (key,)))
+        return diffs
+    if isinstance(oldRepr, list) and isinstance(newRepr, list) and len(oldRepr) == len(newRepr):
+        diffs = []
+        for index, (oldElem, newElem) in enumerate(zip(oldRepr, newRepr)):
+            diffs.extend(simpleReprDiff(oldElem, newElem, path + (str(index),)))
+        return diffs
+    return [] if oldRepr == newRepr else [(path, oldRepr, newRepr)]
+
+
+class G600Shell(cmd.Cmd):
+    """Edits one config in memory.
+    The transport is opened the first time the mouse is needed, and held open
+    until the shell is exited (use it as a context manager).  The mouse is read
+    at most once, and commit only writes the modes that differ from what the
+    mouse holds.
+    """
+    intro = "g600 shell, type help or ? to list commands."
+    prompt = "g600> "
+
+    def __init__(self, transport, debug=False, dryRun=False):
+        super(G600Shell, self).__init__()
+        self.mouseMapping = None
+        # what the mouse holds, as last read or committed, None until it is needed
+        self.baselineRawModeBytesList = None
+        self.transport = transport
+        self.debug = debug
+        self.dryRun = dryRun
+        self._exitStack = contextlib.ExitStack()
+        self._transportOpen = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return self._exitStack.__exit__(excType, excValue, traceback)
+
+    def _openTransport(self):
+        if not self._transportOpen:
+            self._exitStack.enter_context(self.transport)
+            self._transportOpen = True
+
+    def _baseline(self):
+        if self.baselineRawModeBytesList is None:
+            self._openTransport()
+            self.baselineRawModeBytesList = readUsbMouseMappingRawBytes(self.debug, self.transport)
+        return self.baselineRawModeBytesList
+
+    def onecmd(self, line):
+        try:
+            return super(G600Shell, self).onecmd(line)
+        except (ShellError, MappingBuildError, FromJsonError, UsbTransferError, OSError, ValueError) as err:
+            print("error: {}".format(err))
+            return False
+
+    def emptyline(self):
+        # do not repeat the last command, it could be a commit
+        pass
+
+    def do_get(self, arg):
+        """get [PATH]: print a field, or the whole config.  PATH is like mode1.dpi.dpi1, quote it if it has spaces"""
+        path, rest = splitShellPath(arg)
+        if rest.strip() != "":
+            raise ShellError("usage: get [PATH]")
+        field, fullPath = resolveFieldPath(self.mouseMapping, path)
+        print(json.dumps(field.toSimpleRepr(), indent=BaseFieldType.JSON_INDENT))
+
+    def do_set(self, arg):
+        """set PATH VALUE: change a field, VALUE is json or a bare name like F1.  Written to the mouse on commit"""
+        path, valueStr = splitShellPath(arg)
+        if path == "" or valueStr.strip() == "":
+            raise ShellError("usage: set PATH VALUE")
+        field, fullPath = resolveFieldPath(self.mouseMapping, path)
+        schema = buildValidationSchema(type(field))
+        errPath = "".join("[{}]".format(key) for key in fullPath)
+        try:
+            value = json.loads(valueStr)
+        except ValueError:
+            value = valueStr.strip()
+        errors = validateSimpleRepr(schema, value, errPath)
+        if len(errors) > 0 and schema[0] == "leaf" and value != valueStr.strip():
+            # a bare name that also parses as json, like the scan code 1
+            if len(validateSimpleRepr(schema, valueStr.strip(), errPath)) == 0:
+                value, errors = valueStr.strip(), []
+        if len(errors) > 0:
+            raise ShellError("\n".join(errors))
+        field.fromSimpleRepr(value)
+
+    def do_diff(self, arg):
+        """diff: list the fields that differ from the mouse"""
+        baselineMapping = G600MouseMapping()
+        baselineMapping.fromModeRawBytesList(self._baseline())
+        diffs = simpleReprDiff(baselineMapping.simpleRepr, self.mouseMapping.simpleRepr)
+        for path, oldValue, newValue in diffs:
+            print("{}: {} -> {}".format(".".join(path), json.dumps(oldValue), json.dumps(newValue)))
+        if len(diffs) == 0:
+            print("no changes")
+
+    def do_load(self, arg):
+        """load FILE: replace the config being edited with FILE"""
+        args = shlex.split(arg)
+        if len(args) != 1:
+            raise ShellError("usage: load FILE")
+        self.mouseMapping = readMouseMappingFromFile(args[0], self.debug)
+
+    def do_save(self, arg):
+        """save [-f] FILE: save the config being edited to FILE, -f to overwrite an existing FILE"""
+        args = shlex.split(arg)
+        fileNames = [name for name in args if name != "-f"]
+        if len(fileNames) != 1:
+            raise ShellError("usage: save [-f] FILE")
+        try:
+            saveMouseMappingToFile(self.mouseMapping, fileNames[0], "-f" in args)
+        except Exception as err:
+            raise ShellError(str(err)) from err
+
+    def do_commit(self, arg):
+        """commit: write the modes that differ from the mouse to the mouse"""
+        rawModeBytesList = self.mouseMapping.toModeRawBytesList()
+        writeChangedModesToMouse(rawModeBytesList, self._baseline(), self.debug, self.dryRun, self.transport)
+        if not self.dryRun:
+            self.baselineRawModeBytesList = rawModeBytesList
+
+    def do_quit(self, arg):
+        """quit: leave the shell, changes that were not committed are lost"""
+        return True
+
+    do_exit = do_quit
+
+    def do_EOF(self, arg):
+        print()
+        return True
+
+################################################################################
+
+SUBCOMMANDS = {"snapshot": snapshotMain,
+               "rollback": rollbackMain,
+               "lint": lintMain,
+               "shell": shellMain,
+               }
 
 if __name__ == '__main__':
     main(sys.argv)